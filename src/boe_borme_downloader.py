@@ -29,12 +29,30 @@ DATE = "07/10/2023"
 # Argument Parser Library
 from argparse import ArgumentParser
 
+# Concurrency Libraries
+from queue import Queue
+from threading import Lock, Thread
+
+# Date and Time Library
+from datetime import datetime
+
+# Email Utilities Library (HTTP dates)
+from email.utils import formatdate, parsedate_to_datetime
+
 # Logging Library
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 # Operating System Library
 from os import path as os_path
+from os import listdir as os_listdir
 from os import makedirs as os_makedirs
+from os import remove as os_remove
+from os import replace as os_replace
+from os import utime as os_utime
+
+# Shell Utilities Library
+from shutil import copyfileobj
 
 # System Signals Library
 from platform import system as os_system
@@ -49,9 +67,9 @@ from sys import exit as sys_exit
 # Error Traceback Library
 from traceback import format_exc
 
-# Third-Party Libraries
-from request3 import get as requests_get
-import bs4 as bs
+# Third-Party Libraries (requests and lxml) are imported where they are
+# used, to not delay the script startup when they are not needed
+# (i.e. showing help or invalid arguments)
 
 ###############################################################################
 ### Constants
@@ -68,17 +86,34 @@ BORME_SUMMARY_EMITER = "emisor"
 BORME_DOC_TYPE = "PDF"
 BORME_DATA_DIR = "borme"
 
+HTTP_TIMEOUT = 30
+HTTP_MAX_HOST_CONNECTIONS = 8
+
+DOWNLOAD_QUEUE_SIZE = 64
+
+SUMMARY_CHUNK_SIZE = 65536
+
+LOG_PROGRESS_NUM_FILES = 25
+LOG_LEVELS = [logging.WARNING, logging.INFO, logging.DEBUG]
+
 ###############################################################################
 ### Logger Setup
 
+# Log records are queued and written to stderr by a listener thread, so
+# the download threads doesn't block on the stream writes
+log_queue = Queue()
+
 logging.basicConfig(
     #format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     format="%(message)s",
-    level=logging.INFO
+    level=logging.WARNING,
+    handlers=[QueueHandler(log_queue)]
 )
 
 logger = logging.getLogger(__name__)
 
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+
 ###############################################################################
 ### Texts
 
@@ -93,28 +128,19 @@ class TEXT():
     ARG_OUT_DIR = \
         "Specify output directory path to store the downloaded documents."
 
+    ARG_VERBOSE = \
+        "Increase log verbosity (-V for progress info, -VV for each file)."
+
 ###############################################################################
 ### Auxiliary Application Functions
 
-def is_int(element):
-    '''
-    Check if the string is an integer number.
-    '''
-    try:
-        int(element)
-        return True
-    except ValueError:
-        return False
-
-
 def mkdirs(dir_path: str):
     '''
     Create all parents directories from specififed full path
     (mkdir -p $dir_path).
     '''
     try:
-        if not os_path.exists(dir_path):
-            os_makedirs(dir_path, 0o775)
+        os_makedirs(dir_path, 0o775, exist_ok=True)
     except Exception:
         logger.error(format_exc())
         logger.error("Can't create parents directories of %s.", dir_path)
@@ -122,48 +148,174 @@ def mkdirs(dir_path: str):
     return True
 
 
-def http_get(url):
+def file_set_mtime(file_path, http_date):
+    '''
+    Set the modification time of a file from an HTTP date header value
+    (i.e. Last-Modified). An invalid date is just logged as a warning.
+    '''
+    try:
+        mtime = parsedate_to_datetime(http_date).timestamp()
+        os_utime(file_path, (mtime, mtime))
+    except (TypeError, ValueError, OSError):
+        logger.warning("Can't set file modification date (%s) - %s",
+                       http_date, file_path)
+        return False
+    return True
+
+
+def http_session_create():
+    '''
+    Create an HTTP session to be shared by all the requests, so the
+    connections to the server are kept alive and reused between them
+    instead of doing a new TCP and TLS handshake for each file. The number
+    of simultaneous connections to the server is limited to
+    HTTP_MAX_HOST_CONNECTIONS, whatever the number of threads using the
+    session. The requests default Accept-Encoding already asks for all
+    the compressed transfer encodings supported, including brotli when it
+    is installed.
+    '''
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    session = Session()
+    # Pools for two hosts, so a redirect between boe.es and www.boe.es
+    # doesn't evict (and close) the connections pool of the other one
+    adapter = HTTPAdapter(pool_connections=2,
+                          pool_maxsize=HTTP_MAX_HOST_CONNECTIONS,
+                          pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+
+def http_get(session, url, stream=False):
     HTTP_RESPONSE_OK = 200
     logger.info("Downloading summary - %s", url)
-    response = requests_get(url)
+    response = session.get(url, stream=stream, timeout=HTTP_TIMEOUT)
     if response.status_code != HTTP_RESPONSE_OK:
         logger.error(
             "Fail to get web page %s (status code %d)",
             url, response.status_code)
+        response.close()
         return None
     return response
 
 
-def http_download_file(url, dir, overwrite=True):
+def http_download_file(session, url, dir, overwrite=True,
+                       existing_files=None):
     '''
     Download a file from HTTP request through getting an stream of
     chunks and write to specified directory location path. If a file
     with that name already exists in the directory, it can be overwriten
-    or not by the "overwrite" argument.
+    or not by the "overwrite" argument; when not, the file is requested
+    only if it was modified in the server after the local one (HTTP
+    If-Modified-Since request). The file is downloaded to a temporary
+    ".part" file, so if a previous download was interrupted, it is
+    resumed from the already received bytes (HTTP Range request), and
+    its size is checked against the response Content-Length.
+    The directory must already exist. A set with the names of the files
+    already in the directory can be provided through "existing_files" to
+    avoid checking the file system for each file (and its ".part" file).
     '''
-    STREAM_CHUNK_SIZE = 8192
+    HTTP_PARTIAL_CONTENT = 206
+    HTTP_NOT_MODIFIED = 304
+    HTTP_RANGE_NOT_SATISFIABLE = 416
+    STREAM_CHUNK_SIZE = 65536
     # Get file name
-    file_name = url.split('/')[-1]
-    if '=' in file_name:
-        file_name = file_name.split('=')[-1]
-    write_path = f"{dir}/{file_name}"
-    # Check if file already exists
+    file_name = url.rpartition('/')[2].rpartition('=')[2]
+    write_path = os_path.join(dir, file_name)
+    part_path = f"{write_path}.part"
+    # Check if file already exists or was partially downloaded
+    file_exists = False
     if overwrite is False:
-        if os_path.exists(write_path):
-            logger.info("File download skip (already exists) - %s", write_path)
-            return write_path
+        if existing_files is not None:
+            file_exists = file_name in existing_files
+        else:
+            file_exists = os_path.exists(write_path)
+    if existing_files is not None:
+        part_exists = f"{file_name}.part" in existing_files
+    else:
+        part_exists = os_path.exists(part_path)
     try:
-        # Create path driectories
-        if mkdirs(dir) is False:
-            logger.error("Fail to download file at directories creation")
-            return None
+        headers = {}
+        part_size = 0
+        if file_exists:
+            # Request the file just if it was modified after the local one
+            # (its modification time is needed, so already downloaded files
+            # are still stat'ed one by one; the directory listing only saves
+            # the checks of the files not downloaded yet)
+            try:
+                headers["If-Modified-Since"] = formatdate(
+                    os_path.getmtime(write_path), usegmt=True)
+            except OSError:
+                # File removed after the directory listing, download it
+                file_exists = False
+        if not file_exists and part_exists:
+            # Request just the remaining data of a previous partial download
+            part_size = os_path.getsize(part_path)
+            if part_size > 0:
+                # Range must refer to the uncompressed data already stored
+                headers["Range"] = f"bytes={part_size}-"
+                headers["Accept-Encoding"] = "identity"
+                # Get the full file instead if it changed in the server
+                # (partial file has the server modification date)
+                headers["If-Range"] = formatdate(
+                    os_path.getmtime(part_path), usegmt=True)
         # HTTP Get
-        with requests_get(url, allow_redirects=True, stream=True) as r:
+        with session.get(url, headers=headers, stream=True,
+                         allow_redirects=True, timeout=HTTP_TIMEOUT) as r:
+            if r.status_code == HTTP_NOT_MODIFIED:
+                logger.debug("File download skip (not modified) - %s",
+                             write_path)
+                return write_path
+            if r.status_code == HTTP_RANGE_NOT_SATISFIABLE:
+                # Release the connection before any other request
+                r.close()
+                # Partial file already complete (interrupted before rename)
+                content_range = r.headers.get("Content-Range", "")
+                if content_range.rpartition('/')[2] == str(part_size):
+                    os_replace(part_path, write_path)
+                    return write_path
+                # Invalid partial file, download it again from the start
+                # (the directory listing no longer matches, so not used)
+                os_remove(part_path)
+                return http_download_file(session, url, dir, overwrite)
             r.raise_for_status()
-            # File write
-            with open(write_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
-                    f.write(chunk)
+            # File write (append if server sent just the remaining data)
+            if r.status_code == HTTP_PARTIAL_CONTENT:
+                write_mode = "ab"
+            else:
+                write_mode = "wb"
+            # Data is copied through user space (zero-copy from the socket,
+            # like os.sendfile(), is not possible: the connection is TLS
+            # and urllib3 may have already buffered part of the body)
+            r.raw.decode_content = True
+            last_modified = r.headers.get("Last-Modified")
+            try:
+                with open(part_path, write_mode) as f:
+                    write_start = f.tell()
+                    copyfileobj(r.raw, f, length=STREAM_CHUNK_SIZE)
+                    write_size = f.tell() - write_start
+                # Check all data was received (size is only known in
+                # advance for not compressed responses)
+                content_length = r.headers.get("Content-Length")
+                content_encoding = r.headers.get("Content-Encoding",
+                                                 "identity")
+                if (content_length is not None) and \
+                        (content_encoding == "identity"):
+                    if write_size != int(content_length):
+                        raise IOError(f"Incomplete download ({write_size} "
+                                      f"of {content_length} bytes received)")
+            except Exception:
+                # Without server date, a partial file can't be validated to
+                # be resumed (If-Range), so it is discarded
+                if last_modified is None and os_path.exists(part_path):
+                    os_remove(part_path)
+                raise
+            finally:
+                # Keep server modification date for the resume (If-Range)
+                # and the next If-Modified-Since checks
+                if last_modified is not None:
+                    file_set_mtime(part_path, last_modified)
+        os_replace(part_path, write_path)
     except Exception:
         logger.error(format_exc())
         logger.error("Fail to download file - %s", url)
@@ -171,11 +323,96 @@ def http_download_file(url, dir, overwrite=True):
     return write_path
 
 
-def parse_xml(text):
-    parsed = bs.BeautifulSoup(text, features="lxml-xml")
-    if parsed is None:
-        return None
-    return parsed
+# Lock to count the downloaded files of the workers threads
+downloaded_files_lock = Lock()
+
+def http_download_worker(session, queue, downloaded_files, failed_files):
+    '''
+    Download worker thread function. It gets and downloads the files of
+    the queue of pending downloads until a None element is received,
+    adding the path of each successfully downloaded file to the provided
+    "downloaded_files" list, and the URL of each failed one to the
+    "failed_files" list.
+    '''
+    while True:
+        download = queue.get()
+        if download is None:
+            break
+        if app_exit:
+            continue
+        url, dir, overwrite, existing_files = download
+        logger.debug("Downloading file - %s - %s/", url, dir)
+        write_path = http_download_file(session, url, dir, overwrite,
+                                        existing_files)
+        if not write_path:
+            failed_files.append(url)
+        else:
+            with downloaded_files_lock:
+                downloaded_files.append(write_path)
+                num_files = len(downloaded_files)
+            if num_files % LOG_PROGRESS_NUM_FILES == 0:
+                logger.info("Files downloaded: %d", num_files)
+
+
+def http_download_workers_start(session, queue, downloaded_files,
+                                failed_files, num_workers):
+    '''
+    Launch the specified number of download worker threads, which share
+    the HTTP session connections pool and consume the downloads queue.
+    '''
+    workers = []
+    for _ in range(num_workers):
+        worker = Thread(target=http_download_worker,
+                        args=(session, queue, downloaded_files, failed_files),
+                        daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def http_download_workers_stop(queue, workers):
+    '''
+    Wait for all the pending downloads of the queue to be done and stop
+    the download worker threads.
+    '''
+    for _ in workers:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+
+
+def chunks_write_to_file(chunks, file):
+    '''
+    Yield the data chunks of an iterable while writing each of them to
+    the provided file.
+    '''
+    for chunk in chunks:
+        file.write(chunk)
+        yield chunk
+
+
+def xml_iter_elements(chunks, tag):
+    '''
+    Incrementally parse a XML document from an iterable of data chunks
+    (i.e. while it is being received) and yield each element of the
+    specified tag as soon as it is completely parsed. Already processed
+    elements are released to keep memory usage low.
+    '''
+    from lxml import etree
+    def release(element):
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    parser = etree.XMLPullParser(events=("end",), tag=tag)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            yield element
+            release(element)
+    parser.close()
+    for _, element in parser.read_events():
+        yield element
+        release(element)
 
 ###############################################################################
 ### Auxiliary Application Functions
@@ -195,6 +432,8 @@ def parse_options():
                             action='store', type=str, required=True)
     arg_parser.add_argument("-o", "--outdir", help=TEXT.ARG_TYPE,
                             action='store', type=str, required=True)
+    arg_parser.add_argument("-V", "--verbose", help=TEXT.ARG_VERBOSE,
+                            action='count', default=0)
     arg_parser.add_argument("-v", "--version", action="version")
     args = arg_parser.parse_args()
     return vars(args)
@@ -204,23 +443,25 @@ def parse_options():
 
 app_exit = False
 
-def main(argc, argv):
-    # Get arguments
-    arg_options = parse_options()
-    date = arg_options["date"]
-    request_type = arg_options["type"].upper()
-    data_dir = arg_options["outdir"]
-    # Check date valid format
-    if len(date) != 8:
+def bulletin_download(date, request_type, data_dir):
+    '''
+    Download the summary and all the documents of the BOE or BORME
+    bulletin of the specified date into the data directory.
+    '''
+    # Check date valid format (strptime alone accepts not zero-padded
+    # fields, so the 8 digits shape must be checked first)
+    if len(date) != 8 or not (date.isascii() and date.isdigit()):
         logger.error("Invalid date format")
         return 1
-    if not is_int(date):
+    try:
+        date_parsed = datetime.strptime(date, "%Y%m%d")
+    except ValueError:
         logger.error("Invalid date format")
         return 1
     # Get year, month and day
-    date_y = date[:4]
-    date_m = date[4:6]
-    date_d = date[6:8]
+    date_y = f"{date_parsed.year:04d}"
+    date_m = f"{date_parsed.month:02d}"
+    date_d = f"{date_parsed.day:02d}"
     # Set config depending on BOE or BORME request
     if request_type == "BOE":
         summary_url = BOE_SUMMARY_URL
@@ -239,49 +480,111 @@ def main(argc, argv):
     else:
         logger.error("Invalid type (expected BOE or BORME)")
         return 1
+    from lxml import etree
+    # Precompile the XPath expression to get the document URL of an item
+    if doc_type == BOE_DOC_TYPE:
+        get_item_doc_url = etree.XPath("string(urlXml)")
+    else:
+        get_item_doc_url = etree.XPath("string(urlPdf)")
+    # Create HTTP session to reuse server connections
+    session = http_session_create()
     # Get BOE Summary Document
     summary_url = f"{summary_url}{date}"
     summary_dir = f"{data_dir}/{date_y}/{date_m}/{date_d}"
-    http_download_file(summary_url, summary_dir, False)
-    boe_summary_http_res = http_get(summary_url)
+    if mkdirs(summary_dir) is False:
+        return 1
+    summary_file_name = summary_url.rpartition('=')[2]
+    summary_path = os_path.join(summary_dir, summary_file_name)
+    summary_part_path = f"{summary_path}.part"
+    boe_summary_http_res = http_get(session, summary_url, stream=True)
     if boe_summary_http_res is None:
         return 1
-    boe_summary_http_res.encoding="utf-8"
-    boe_summary = parse_xml(boe_summary_http_res.text)
-    if boe_summary is None:
+    # Get all the department documents while the summary is received
+    # (and stored), queuing each document to be downloaded as soon as it
+    # is parsed
+    download_queue = Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+    downloaded_files = []
+    failed_files = []
+    # One of the host connections is used by the summary stream during
+    # all the parse, so one worker less than connections is launched
+    workers = http_download_workers_start(
+        session, download_queue, downloaded_files, failed_files,
+        HTTP_MAX_HOST_CONNECTIONS - 1)
+    try:
+        with boe_summary_http_res, open(summary_part_path, "wb") as f:
+            summary_chunks = chunks_write_to_file(
+                boe_summary_http_res.iter_content(
+                    chunk_size=SUMMARY_CHUNK_SIZE), f)
+            boe_departments = xml_iter_elements(summary_chunks, emiter)
+            for department in boe_departments:
+                if app_exit:
+                    break
+                dept_id = department.get("etq")
+                # Create department directory
+                dept_dir = f"{summary_dir}/{dept_id}"
+                dept_dir_ok = mkdirs(dept_dir)
+                if dept_dir_ok:
+                    existing_files = set(os_listdir(dept_dir))
+                else:
+                    logger.error("BOE documents skipped!")
+                    logger.error("%s", etree.tostring(department))
+                # Get all documents from this department
+                for item in department.iterfind(".//item"):
+                    doc_url = get_item_doc_url(item)
+                    if not doc_url:
+                        logger.error("Document without URL - %s",
+                                     item.get("id"))
+                        failed_files.append(item.get("id"))
+                        continue
+                    doc = f"{BOE_URL}{doc_url}"
+                    if not dept_dir_ok:
+                        failed_files.append(doc)
+                        continue
+                    download_queue.put((doc, dept_dir, False, existing_files))
+        # Keep the summary file just if it was completely received
+        if not app_exit:
+            os_replace(summary_part_path, summary_path)
+    except etree.XMLSyntaxError:
+        logger.error(format_exc())
+        logger.error("Fail to parse summary - %s", summary_url)
         return 1
-    # Get all the department documents
-    num_downloaded_files = 0
-    boe_departments = boe_summary.find_all(emiter)
-    for department in boe_departments:
-        if app_exit:
-            break
-        dept_id = department["etq"]
-        # Create department directory
-        dept_dir = f"{summary_dir}/{dept_id}"
-        if mkdirs(dept_dir) is False:
-            logger.error("BOE documents skipped!")
-            logger.error("%s", department)
-            continue
-        # Get all documents from this department
-        boe_items = department.find_all("item")
-        for item in boe_items:
-            if app_exit:
-                break
-            if doc_type == BOE_DOC_TYPE:
-                doc = f"{BOE_URL}{item.urlXml.get_text()}"
-            else:
-                doc = f"{BOE_URL}{item.urlPdf.get_text()}"
-            logger.info("Downloading file - %s - %s/", doc, dept_dir)
-            if http_download_file(doc, dept_dir, False):
-                num_downloaded_files = num_downloaded_files + 1
+    except OSError:
+        # Summary file write or connection error (requests exceptions)
+        logger.error(format_exc())
+        logger.error("Fail to get summary - %s", summary_url)
+        return 1
+    finally:
+        http_download_workers_stop(download_queue, workers)
+    num_downloaded_files = len(downloaded_files)
     logger.info("Num files downloaded: %d", num_downloaded_files)
     if app_exit:
         logger.info("Operation stopped by user")
+    elif failed_files:
+        logger.error("Operation completed with %d files not downloaded",
+                     len(failed_files))
+        return 1
     else:
         logger.info("Operation completed")
     return 0
 
+
+def main(argc, argv):
+    # Get arguments
+    arg_options = parse_options()
+    date = arg_options["date"]
+    request_type = arg_options["type"].upper()
+    data_dir = arg_options["outdir"]
+    # Set log verbosity level and start writing the log records
+    log_level = LOG_LEVELS[min(arg_options["verbose"], len(LOG_LEVELS) - 1)]
+    logger.setLevel(log_level)
+    log_listener.start()
+    try:
+        logger.info("{} v{} {}\n".format(
+            os_path.basename(NAME), VERSION, DATE))
+        return bulletin_download(date, request_type, data_dir)
+    finally:
+        log_listener.stop()
+
 ###############################################################################
 ### System Termination Signals Management
 
@@ -308,7 +611,6 @@ def system_termination_signal_setup():
 ### Runnable Main Script Detection
 
 if __name__ == '__main__':
-    logger.info("{} v{} {}\n".format(os_path.basename(NAME), VERSION, DATE))
     system_termination_signal_setup()
     return_code = main(len(sys_argv) - 1, sys_argv[1:])
     sys_exit(return_code)